@@ -1,26 +1,79 @@
 import os
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
 import concurrent.futures
+import json
+import shutil
+import threading
 import time
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Set, Tuple
 from datetime import datetime
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # Fall back to the standard library parser
+    json_loads = json.loads
+
 class PDBDownloader:
-    def __init__(self):
+    def __init__(self, max_workers: int = 20):
         # Create output directories
         self.output_dir = "datasets/raw/pdb"
         self.ids_dir = "datasets/raw/pdb_ids"
         os.makedirs(self.output_dir, exist_ok=True)
         os.makedirs(self.ids_dir, exist_ok=True)
+        self.ids_file = os.path.join(self.ids_dir, "pdb_ids.txt")
+        self.manifest_file = os.path.join(self.ids_dir, "manifest.json")
+        self._shard_dirs: Set[str] = set()  # Shard directories known to exist
 
         # Download failure configurations
         self.failed_downloads: Dict[str, DownloadFailure] = {}
-        self.MAX_RETRY_ATTEMPTS = 3
-        self.RETRY_WAIT_TIME = 300  # 5 minutes before retry
-        self.max_workers = 20  # Maximum number of parallel download threads
+        self._fail_lock = threading.Lock()  # Guards failed_downloads across threads
+        self.MAX_RETRY_ATTEMPTS = 3  # Retries per file after the first attempt
+        self.BACKOFF_FACTOR = 1.0  # Seconds, doubled on each retry
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be a positive integer, got {max_workers}")
+        self.max_workers = max_workers  # Maximum number of parallel download threads
+
+        # Transient errors are retried inline on the pooled connection with
+        # exponential backoff; anything still failing ends up in the summary
+        retry = Retry(total=self.MAX_RETRY_ATTEMPTS,
+                      backoff_factor=self.BACKOFF_FACTOR,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET", "POST"]),
+                      respect_retry_after_header=True)
+
+        # Shared HTTP session so worker threads reuse keep-alive connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.max_workers,
+                              max_retries=retry)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        """Close the underlying HTTP session"""
+        self.session.close()
 
-    def fetch_pdb_ids(self, cutoff_date: str = "2020-01-01", batch_size: int = 1000) -> List[str]:
+    def fetch_pdb_ids(self, cutoff_date: str = "2020-01-01") -> List[str]:
         """Fetch all PDB IDs before the specified cutoff date"""
+        cached_ids = self._load_cached_ids(cutoff_date)
+        if cached_ids is not None:
+            print(f"Loaded {len(cached_ids)} cached PDB IDs for entries before "
+                  f"{cutoff_date} from {self.ids_file}")
+            return cached_ids
+
+        # Invalidate the old manifest until the new enumeration completes
+        if os.path.exists(self.manifest_file):
+            os.remove(self.manifest_file)
+
         print(f"Fetching PDB IDs for entries before {cutoff_date}...")
         
         url = "https://search.rcsb.org/rcsbsearch/v2/query"
@@ -38,8 +91,9 @@ class PDBDownloader:
             "request_options": {
                 "paginate": {
                     "start": 0,
-                    "rows": 100
+                    "rows": 10000
                 },
+                "results_verbosity": "compact",
                 "sort": [
                     {
                         "sort_by": "rcsb_accession_info.initial_release_date",
@@ -51,68 +105,104 @@ class PDBDownloader:
 
         all_pdb_ids = []
         start = 0
-        rows = 100
-        batch_count = 0
-
-        while True:
-            query_template["request_options"]["paginate"]["start"] = start
-            query_template["request_options"]["paginate"]["rows"] = rows
-
-            try:
-                response = requests.post(url, json=query_template)
-                response.raise_for_status()
-                
-                result_set = response.json().get("result_set", [])
-                if not result_set:
-                    break
+        rows = 10000  # Maximum page size accepted by the RCSB search API
+        complete = False
 
-                pdb_ids = [entry["identifier"] for entry in result_set]
-                all_pdb_ids.extend(pdb_ids)
-                print(f"Fetched {len(pdb_ids)} PDB entries (total: {len(all_pdb_ids)}).")
+        # Append each page to a single IDs file as it arrives
+        with open(self.ids_file, "w", buffering=1 << 20) as ids_f:
+            while True:
+                query_template["request_options"]["paginate"]["start"] = start
+                query_template["request_options"]["paginate"]["rows"] = rows
 
-                start += rows
+                try:
+                    response = self.session.post(url, json=query_template)
+                    response.raise_for_status()
+                    if response.status_code == 204:  # Paged past the last result
+                        complete = True
+                        break
+                    
+                    result_set = json_loads(response.content).get("result_set", [])
+                    if not result_set:
+                        complete = True
+                        break
 
-                # Save IDs to file when reaching batch size
-                if len(all_pdb_ids) >= (batch_count + 1) * batch_size:
-                    self._save_batch_ids(all_pdb_ids, batch_count, batch_size)
-                    batch_count += 1
+                    # Compact verbosity returns a plain list of identifiers
+                    pdb_ids = result_set
+                    all_pdb_ids.extend(pdb_ids)
+                    for pdb_id in pdb_ids:
+                        ids_f.write(pdb_id)
+                        ids_f.write("\n")
+                    print(f"Fetched {len(pdb_ids)} PDB entries (total: {len(all_pdb_ids)}).")
 
-            except requests.exceptions.RequestException as e:
-                print(f"Error fetching PDB IDs: {e}")
-                break
+                    start += rows
 
-        # Save remaining IDs
-        if len(all_pdb_ids) > batch_count * batch_size:
-            self._save_batch_ids(all_pdb_ids, batch_count, batch_size)
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    print(f"Error fetching PDB IDs: {e}")
+                    break
 
         print(f"Found {len(all_pdb_ids)} PDB entries in total.")
+        print(f"Saved PDB IDs to {self.ids_file}")
+
+        # Only a full enumeration is safe to reuse on later runs
+        if complete:
+            manifest = {
+                "cutoff_date": cutoff_date,
+                "count": len(all_pdb_ids)
+            }
+            temp_file = f"{self.manifest_file}.part"
+            with open(temp_file, "w") as f:
+                json.dump(manifest, f)
+            os.replace(temp_file, self.manifest_file)
         return all_pdb_ids
 
-    def _save_batch_ids(self, all_ids: List[str], batch_count: int, batch_size: int) -> None:
-        """Save a batch of PDB IDs to file"""
-        batch_ids = all_ids[batch_count * batch_size:(batch_count + 1) * batch_size]
-        batch_file = os.path.join(self.ids_dir, f"pdb_ids_batch_{batch_count}.txt")
-        with open(batch_file, "w") as f:
-            f.write("\n".join(batch_ids))
-        print(f"Saved batch {batch_count} with {len(batch_ids)} IDs to {batch_file}")
+    def _load_cached_ids(self, cutoff_date: str) -> Optional[List[str]]:
+        """Load previously fetched PDB IDs if they match the cutoff date"""
+        if not (os.path.exists(self.manifest_file) and os.path.exists(self.ids_file)):
+            return None
 
-    def download_structures(self) -> None:
+        # A truncated or corrupt manifest is treated as a cache miss
+        try:
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+        except (ValueError, OSError):
+            return None
+        if not isinstance(manifest, dict) or manifest.get("cutoff_date") != cutoff_date:
+            return None
+
+        with open(self.ids_file, "r") as f:
+            pdb_ids = [line.strip() for line in f if line.strip()]
+        if len(pdb_ids) != manifest.get("count"):
+            return None
+        return pdb_ids
+
+    def download_structures(self, batch_size: int = 1000) -> None:
         """Download all PDB structure files"""
         print("\nStarting structure downloads...")
-        batch_files = sorted([f for f in os.listdir(self.ids_dir) if f.startswith("pdb_ids_batch_")])
-        total_batches = len(batch_files)
+        with open(self.ids_file, "r") as f:
+            all_pdb_ids = [line.strip() for line in f if line.strip()]
+
+        # RCSB paging can repeat entries across page boundaries; a repeated ID
+        # would otherwise be downloaded twice at once into the same .part file
+        all_pdb_ids = set(all_pdb_ids)
+
+        # Filter out finished structures with one directory listing, and submit
+        # the rest in a stable sorted order so neighbouring files go back-to-back
+        existing = self._existing_ids()
+        total = len(all_pdb_ids)
+        all_pdb_ids = sorted(all_pdb_ids - existing)
+        print(f"Skipping {total - len(all_pdb_ids)} already downloaded structures")
 
-        for batch_index, batch_file in enumerate(batch_files, 1):
+        batches = [all_pdb_ids[i:i + batch_size] for i in range(0, len(all_pdb_ids), batch_size)]
+        total_batches = len(batches)
+
+        for batch_index, pdb_ids in enumerate(batches, 1):
             print(f"\nProcessing batch {batch_index}/{total_batches} "
-                  f"({batch_index/total_batches*100:.1f}%) - {batch_file}")
-            
-            with open(os.path.join(self.ids_dir, batch_file), "r") as f:
-                pdb_ids = [line.strip() for line in f.readlines()]
+                  f"({batch_index/total_batches*100:.1f}%)")
             
             print(f"Current batch contains {len(pdb_ids)} IDs")
             self._process_batch(pdb_ids)
             
-            print(f"Completed batch file {batch_file}")
+            print(f"Completed batch {batch_index}")
             remaining_batches = total_batches - batch_index
             print(f"Remaining batches: {remaining_batches}")
             print(f"Current failed downloads: {len(self.failed_downloads)}")
@@ -121,29 +211,69 @@ class PDBDownloader:
                 print("Taking a short break before next batch...")
                 time.sleep(2)
 
-        # Process failed downloads
-        if self.failed_downloads:
-            print(f"\nProcessing {len(self.failed_downloads)} failed downloads...")
-            self._retry_failed_downloads()
-
         # Output final failure statistics
         self._save_failure_summary()
 
+    def _output_path(self, pdb_id: str) -> str:
+        """Local path of the gzipped CIF file for a PDB ID"""
+        # Shard by the middle two characters (as the wwPDB archive does)
+        # to keep every directory small
+        shard = pdb_id[1:3].lower()
+        return os.path.join(self.output_dir, shard, f"{pdb_id}.cif.gz")
+
+    def _existing_ids(self) -> Set[str]:
+        """Get IDs whose CIF file is already in the output directory"""
+        suffix = ".cif.gz"
+        existing = set()
+        with os.scandir(self.output_dir) as shards:
+            for shard in shards:
+                if not shard.is_dir():
+                    continue
+                existing.update(name[:-len(suffix)] for name in os.listdir(shard.path)
+                                if name.endswith(suffix))
+        return existing
+
     def _download_single_file(self, pdb_id: str) -> Tuple[bool, str]:
         """Download a single PDB file"""
-        cif_url = f"https://files.rcsb.org/download/{pdb_id}.cif"
-        try:
-            response = requests.get(cif_url, timeout=30)
-            if response.status_code == 200:
-                with open(os.path.join(self.output_dir, f"{pdb_id}.cif"), "wb") as f:
-                    f.write(response.content)
-                return True, f"Successfully downloaded {pdb_id}.cif"
-            else:
-                error_msg = f"Failed to download {pdb_id}.cif, status code: {response.status_code}"
-                return False, error_msg
-        except Exception as e:
-            error_msg = f"Error downloading {pdb_id}.cif: {str(e)}"
-            return False, error_msg
+        output_file = self._output_path(pdb_id)
+        temp_file = f"{output_file}.part"
+        shard_dir = os.path.dirname(output_file)
+        # Fetch the pre-compressed variant; it is several times smaller on the wire
+        cif_url = f"https://files.rcsb.org/download/{pdb_id}.cif.gz"
+        for attempt in range(self.MAX_RETRY_ATTEMPTS + 1):
+            if attempt > 0:
+                time.sleep(self.BACKOFF_FACTOR * 2 ** (attempt - 1))
+            try:
+                with self.session.get(cif_url, stream=True, timeout=30) as response:
+                    if response.status_code == 200:
+                        if shard_dir not in self._shard_dirs:
+                            os.makedirs(shard_dir, exist_ok=True)
+                            self._shard_dirs.add(shard_dir)
+
+                        # Stream to a staging file, then rename so a complete file
+                        # is the only thing that ever appears at output_file. The raw
+                        # gzip bytes are copied as served, in large unbuffered chunks.
+                        response.raw.decode_content = False
+                        response.raw.enforce_content_length = True
+                        with open(temp_file, "wb", buffering=0) as f:
+                            shutil.copyfileobj(response.raw, f, length=1 << 20)
+                        os.replace(temp_file, output_file)
+                        return True, f"Successfully downloaded {pdb_id}.cif.gz"
+                    else:
+                        error_msg = f"Failed to download {pdb_id}.cif.gz, status code: {response.status_code}"
+                        return False, error_msg
+            except Exception as e:
+                # Don't leave a partial staging file behind
+                try:
+                    os.remove(temp_file)
+                except FileNotFoundError:
+                    pass
+                error_msg = f"Error downloading {pdb_id}.cif.gz: {str(e)}"
+                # urllib3.Retry stops retrying once response headers arrive, so a
+                # body cut off mid-stream is retried here; anything else is final
+                if not isinstance(e, (ProtocolError, ReadTimeoutError)):
+                    return False, error_msg
+        return False, error_msg
 
     def _process_batch(self, pdb_ids: List[str]) -> None:
         """Process a batch of PDB IDs for downloading"""
@@ -158,53 +288,22 @@ class PDBDownloader:
                 pdb_id = future_to_pdb[future]
                 try:
                     success, result = future.result()
-                    completed += 1
                     if not success:
                         self._record_failure(pdb_id, result)
-                    
-                    if completed % 10 == 0 or completed == total:
-                        print(f"Batch progress: {completed}/{total} "
-                              f"({completed/total*100:.1f}%) - {result}")
                 except Exception as e:
                     print(f"Error processing {pdb_id}: {str(e)}")
+                completed += 1
+
+                # Report in chunks to keep terminal writes off the critical path
+                if completed % 100 == 0 or completed == total:
+                    print(f"Batch progress: {completed}/{total} "
+                          f"({completed/total*100:.1f}%)")
 
     def _record_failure(self, pdb_id: str, error_msg: str) -> None:
         """Record a failed download attempt"""
-        if pdb_id in self.failed_downloads:
-            self.failed_downloads[pdb_id].attempt += 1
-            self.failed_downloads[pdb_id].error_msg = error_msg
-            self.failed_downloads[pdb_id].timestamp = time.time()
-        else:
+        with self._fail_lock:
             self.failed_downloads[pdb_id] = DownloadFailure(pdb_id, error_msg)
 
-    def _retry_failed_downloads(self) -> None:
-        """Retry failed downloads after waiting period"""
-        while self.failed_downloads:
-            current_time = time.time()
-            retry_pdb_ids = [
-                pdb_id for pdb_id, failure in self.failed_downloads.items()
-                if failure.attempt < self.MAX_RETRY_ATTEMPTS and 
-                (current_time - failure.timestamp) >= self.RETRY_WAIT_TIME
-            ]
-            
-            if not retry_pdb_ids:
-                print("Waiting for retry cooldown...")
-                time.sleep(60)
-                continue
-                
-            print(f"\nRetrying {len(retry_pdb_ids)} failed downloads...")
-            self._process_batch(retry_pdb_ids)
-            
-            # Clean up completed or max-attempted entries
-            for pdb_id in list(self.failed_downloads.keys()):
-                if pdb_id not in retry_pdb_ids:
-                    continue
-                if self.failed_downloads[pdb_id].attempt >= self.MAX_RETRY_ATTEMPTS:
-                    print(f"Maximum retry attempts reached for {pdb_id}")
-                    del self.failed_downloads[pdb_id]
-                elif os.path.exists(os.path.join(self.output_dir, f"{pdb_id}.cif")):
-                    del self.failed_downloads[pdb_id]
-
     def _save_failure_summary(self) -> None:
         """Save summary of failed downloads"""
         if not self.failed_downloads:
@@ -212,33 +311,42 @@ class PDBDownloader:
 
         print("\nFinal failed downloads summary:")
         for pdb_id, failure in self.failed_downloads.items():
-            print(f"- {pdb_id}: Failed {failure.attempt} times. Last error: {failure.error_msg}")
+            print(f"- {pdb_id}: {failure.error_msg}")
         
         failure_file = os.path.join("datasets", "failed_downloads_pdb_cif.txt")
         with open(failure_file, "w") as f:
             for pdb_id, failure in self.failed_downloads.items():
-                f.write(f"{pdb_id}\t{failure.attempt}\t{failure.error_msg}\n")
+                f.write(f"{pdb_id}\t{failure.error_msg}\n")
         print(f"\nFailed downloads have been saved to '{failure_file}'")
 
 class DownloadFailure:
     """Class for tracking download failures"""
-    def __init__(self, pdb_id: str, error_msg: str, attempt: int = 1):
+    def __init__(self, pdb_id: str, error_msg: str):
         self.pdb_id = pdb_id
         self.error_msg = error_msg
-        self.attempt = attempt
-        self.timestamp = time.time()
+
+def positive_int(value: str) -> int:
+    """Argparse type for options that must be a positive integer"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
 
 def main():
+    parser = argparse.ArgumentParser(description="Download PDB structure files")
+    parser.add_argument("--max-workers", type=positive_int, default=20,
+                        help="Number of parallel download threads (default: 20)")
+    args = parser.parse_args()
+
     start_time = time.time()
     print(f"Starting PDB data download process at {datetime.now()}")
     
-    downloader = PDBDownloader()
-    
-    # Step 1: Fetch PDB IDs
-    downloader.fetch_pdb_ids()
-    
-    # Step 2: Download structure files
-    downloader.download_structures()
+    with PDBDownloader(max_workers=args.max_workers) as downloader:
+        # Step 1: Fetch PDB IDs
+        downloader.fetch_pdb_ids()
+
+        # Step 2: Download structure files
+        downloader.download_structures()
     
     end_time = time.time()
     duration = end_time - start_time
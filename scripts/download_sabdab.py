@@ -1,13 +1,19 @@
 import os
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
 import concurrent.futures
+import shutil
+import threading
 import time
-from typing import List, Dict, Tuple
+from typing import List, Dict, Set, Tuple
 from datetime import datetime
 from tqdm import tqdm
 
 class SabdabDownloader:
-    def __init__(self):
+    def __init__(self, max_workers: int = 8):
         # Create output directories
         self.output_dir = "datasets/raw/sabdab"
         self.ids_dir = "datasets/raw/sabdab_ids"
@@ -16,9 +22,38 @@ class SabdabDownloader:
 
         # Download failure configurations
         self.failed_downloads: Dict[str, DownloadFailure] = {}
-        self.MAX_RETRY_ATTEMPTS = 3
-        self.RETRY_WAIT_TIME = 300  # 5 minutes before retry
-        self.max_workers = 8  # Maximum number of parallel download threads
+        self._fail_lock = threading.Lock()  # Guards failed_downloads across threads
+        self.MAX_RETRY_ATTEMPTS = 3  # Retries per file after the first attempt
+        self.BACKOFF_FACTOR = 1.0  # Seconds, doubled on each retry
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be a positive integer, got {max_workers}")
+        self.max_workers = max_workers  # Maximum number of parallel download threads
+
+        # Transient errors are retried inline on the pooled connection with
+        # exponential backoff; anything still failing ends up in the summary
+        retry = Retry(total=self.MAX_RETRY_ATTEMPTS,
+                      backoff_factor=self.BACKOFF_FACTOR,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET", "POST"]),
+                      respect_retry_after_header=True)
+
+        # Shared HTTP session so worker threads reuse keep-alive connections.
+        # A single pool for the one SAbDab host, sized to the worker count.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.max_workers,
+                              max_retries=retry)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        """Close the underlying HTTP session"""
+        self.session.close()
 
     def fetch_pdb_ids(self) -> List[str]:
         """Fetch PDB IDs from SAbDab summary file"""
@@ -27,55 +62,77 @@ class SabdabDownloader:
         if not os.path.exists(tsv_file):
             raise FileNotFoundError(f"Summary file not found: {tsv_file}")
         
-        pdb_ids = []
+        unique_ids = set()
         print("Reading SAbDab summary file...")
         
+        # Stream line by line, collecting unique IDs as we go
         with open(tsv_file, "r") as f:
-            lines = f.readlines()
-            for line in lines[1:]:  # Skip header
-                columns = line.strip().split("\t")
-                pdb_id = columns[0]  # PDB ID is in first column
-                pdb_ids.append(pdb_id)
+            next(f, None)  # Skip header
+            for line in f:
+                pdb_id = line.partition("\t")[0].strip()  # PDB ID is in first column
+                if pdb_id:
+                    unique_ids.add(pdb_id)
         
-        # Remove duplicates
-        pdb_ids = list(set(pdb_ids))
+        pdb_ids = list(unique_ids)
         print(f"Found {len(pdb_ids)} unique PDB IDs in SAbDab database")
         return pdb_ids
 
     def download_structures(self, pdb_ids: List[str]) -> None:
         """Download all SAbDab structure files"""
         print("\nStarting structure downloads...")
-        self._process_batch(pdb_ids)
 
-        # Process failed downloads
-        if self.failed_downloads:
-            print(f"\nProcessing {len(self.failed_downloads)} failed downloads...")
-            self._retry_failed_downloads()
+        # Filter out finished structures with one directory listing, and submit
+        # the rest in a stable sorted order so neighbouring files go back-to-back
+        existing = self._existing_ids()
+        total = len(pdb_ids)
+        pdb_ids = sorted(pdb_id for pdb_id in pdb_ids if pdb_id not in existing)
+        print(f"Skipping {total - len(pdb_ids)} already downloaded structures")
+        self._process_batch(pdb_ids)
 
         # Output final failure statistics
         self._save_failure_summary()
 
+    def _existing_ids(self) -> Set[str]:
+        """Get IDs whose structure file is already in the output directory"""
+        suffix = ".pdb"
+        return {name[:-len(suffix)] for name in os.listdir(self.output_dir)
+                if name.endswith(suffix)}
+
     def _download_single_file(self, pdb_id: str) -> Tuple[bool, str]:
         """Download a single structure file from SAbDab"""
         output_file = os.path.join(self.output_dir, f"{pdb_id}.pdb")
-        
-        # Skip if file already exists
-        if os.path.exists(output_file):
-            return True, f"Already downloaded {pdb_id}.pdb"
-        
+        temp_file = f"{output_file}.part"
         url = f"https://opig.stats.ox.ac.uk/webapps/sabdab-sabpred/sabdab/pdb/{pdb_id}"
-        try:
-            response = requests.get(url, timeout=30)
-            if response.status_code == 200:
-                with open(output_file, "w") as f:
-                    f.write(response.text)
-                return True, f"Successfully downloaded {pdb_id}.pdb"
-            else:
-                error_msg = f"Failed to download {pdb_id}.pdb, status code: {response.status_code}"
-                return False, error_msg
-        except Exception as e:
-            error_msg = f"Error downloading {pdb_id}.pdb: {str(e)}"
-            return False, error_msg
+        for attempt in range(self.MAX_RETRY_ATTEMPTS + 1):
+            if attempt > 0:
+                time.sleep(self.BACKOFF_FACTOR * 2 ** (attempt - 1))
+            try:
+                with self.session.get(url, stream=True, timeout=30) as response:
+                    if response.status_code == 200:
+                        # Stream to a staging file, then rename so a complete file
+                        # is the only thing that ever appears at output_file. The body
+                        # is copied straight from the socket in large unbuffered chunks.
+                        response.raw.decode_content = True
+                        response.raw.enforce_content_length = True
+                        with open(temp_file, "wb", buffering=0) as f:
+                            shutil.copyfileobj(response.raw, f, length=1 << 20)
+                        os.replace(temp_file, output_file)
+                        return True, f"Successfully downloaded {pdb_id}.pdb"
+                    else:
+                        error_msg = f"Failed to download {pdb_id}.pdb, status code: {response.status_code}"
+                        return False, error_msg
+            except Exception as e:
+                # Don't leave a partial staging file behind
+                try:
+                    os.remove(temp_file)
+                except FileNotFoundError:
+                    pass
+                error_msg = f"Error downloading {pdb_id}.pdb: {str(e)}"
+                # urllib3.Retry stops retrying once response headers arrive, so a
+                # body cut off mid-stream is retried here; anything else is final
+                if not isinstance(e, (ProtocolError, ReadTimeoutError)):
+                    return False, error_msg
+        return False, error_msg
 
     def _process_batch(self, pdb_ids: List[str]) -> None:
         """Process a batch of PDB IDs for downloading"""
@@ -83,57 +140,28 @@ class SabdabDownloader:
             future_to_pdb = {executor.submit(self._download_single_file, pdb_id): pdb_id 
                            for pdb_id in pdb_ids}
             
-            # Use tqdm for progress tracking
-            with tqdm(total=len(pdb_ids), desc="Downloading") as pbar:
+            # Use tqdm for progress tracking, updating in chunks rather than per file
+            pending = 0
+            with tqdm(total=len(pdb_ids), desc="Downloading", mininterval=0.5) as pbar:
                 for future in concurrent.futures.as_completed(future_to_pdb):
                     pdb_id = future_to_pdb[future]
                     try:
                         success, result = future.result()
                         if not success:
                             self._record_failure(pdb_id, result)
-                        pbar.update(1)
-                        pbar.set_postfix_str(result)
                     except Exception as e:
                         print(f"Error processing {pdb_id}: {str(e)}")
-                        pbar.update(1)
+                    pending += 1
+                    if pending >= 100:
+                        pbar.update(pending)
+                        pending = 0
+                pbar.update(pending)
 
     def _record_failure(self, pdb_id: str, error_msg: str) -> None:
         """Record a failed download attempt"""
-        if pdb_id in self.failed_downloads:
-            self.failed_downloads[pdb_id].attempt += 1
-            self.failed_downloads[pdb_id].error_msg = error_msg
-            self.failed_downloads[pdb_id].timestamp = time.time()
-        else:
+        with self._fail_lock:
             self.failed_downloads[pdb_id] = DownloadFailure(pdb_id, error_msg)
 
-    def _retry_failed_downloads(self) -> None:
-        """Retry failed downloads after waiting period"""
-        while self.failed_downloads:
-            current_time = time.time()
-            retry_pdb_ids = [
-                pdb_id for pdb_id, failure in self.failed_downloads.items()
-                if failure.attempt < self.MAX_RETRY_ATTEMPTS and 
-                (current_time - failure.timestamp) >= self.RETRY_WAIT_TIME
-            ]
-            
-            if not retry_pdb_ids:
-                print("Waiting for retry cooldown...")
-                time.sleep(60)
-                continue
-                
-            print(f"\nRetrying {len(retry_pdb_ids)} failed downloads...")
-            self._process_batch(retry_pdb_ids)
-            
-            # Clean up completed or max-attempted entries
-            for pdb_id in list(self.failed_downloads.keys()):
-                if pdb_id not in retry_pdb_ids:
-                    continue
-                if self.failed_downloads[pdb_id].attempt >= self.MAX_RETRY_ATTEMPTS:
-                    print(f"Maximum retry attempts reached for {pdb_id}")
-                    del self.failed_downloads[pdb_id]
-                elif os.path.exists(os.path.join(self.output_dir, f"{pdb_id}.pdb")):
-                    del self.failed_downloads[pdb_id]
-
     def _save_failure_summary(self) -> None:
         """Save summary of failed downloads"""
         if not self.failed_downloads:
@@ -141,33 +169,42 @@ class SabdabDownloader:
 
         print("\nFinal failed downloads summary:")
         for pdb_id, failure in self.failed_downloads.items():
-            print(f"- {pdb_id}: Failed {failure.attempt} times. Last error: {failure.error_msg}")
+            print(f"- {pdb_id}: {failure.error_msg}")
         
         failure_file = os.path.join("datasets", "failed_downloads_sabdab.txt")
         with open(failure_file, "w") as f:
             for pdb_id, failure in self.failed_downloads.items():
-                f.write(f"{pdb_id}\t{failure.attempt}\t{failure.error_msg}\n")
+                f.write(f"{pdb_id}\t{failure.error_msg}\n")
         print(f"\nFailed downloads have been saved to '{failure_file}'")
 
 class DownloadFailure:
     """Class for tracking download failures"""
-    def __init__(self, pdb_id: str, error_msg: str, attempt: int = 1):
+    def __init__(self, pdb_id: str, error_msg: str):
         self.pdb_id = pdb_id
         self.error_msg = error_msg
-        self.attempt = attempt
-        self.timestamp = time.time()
+
+def positive_int(value: str) -> int:
+    """Argparse type for options that must be a positive integer"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
 
 def main():
+    parser = argparse.ArgumentParser(description="Download SAbDab structure files")
+    parser.add_argument("--max-workers", type=positive_int, default=8,
+                        help="Number of parallel download threads (default: 8)")
+    args = parser.parse_args()
+
     start_time = time.time()
     print(f"Starting SAbDab data download process at {datetime.now()}")
     
-    downloader = SabdabDownloader()
-    
-    # Step 1: Fetch PDB IDs
-    pdb_ids = downloader.fetch_pdb_ids()
-    
-    # Step 2: Download structure files
-    downloader.download_structures(pdb_ids)
+    with SabdabDownloader(max_workers=args.max_workers) as downloader:
+        # Step 1: Fetch PDB IDs
+        pdb_ids = downloader.fetch_pdb_ids()
+
+        # Step 2: Download structure files
+        downloader.download_structures(pdb_ids)
     
     end_time = time.time()
     duration = end_time - start_time